@@ -1,79 +1,131 @@
 import pandas as pd
-import requests
+import numpy as np
+import httpx
+import orjson
+import asyncio
 import time
-import math
 import os
+import random
+import uuid
+from itertools import islice
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ====== CONFIG ======
 TMDB_API_KEY = "275dba03fdc2e0550032ae189c33a322"   # <- your key
 INPUT_CSV = "tmdb_api_movies_filtered.csv"           # file with 'id' column (36k file)
 OUTPUT_CSV = "tmdb_api_movies_enriched.csv"
-TEMP_PROGRESS = "tmdb_enriched_progress.csv"
+TEMP_PROGRESS = "tmdb_enriched_progress"       # directory of parquet part files (append-only checkpoint)
+FAILED_IDS_FILE = "tmdb_failed_ids.txt"        # ids that 404'd etc. -> never re-fetched on resume
 
-MAX_WORKERS = 4          # safe parallelism (reduce if you hit 429)
+MAX_CONCURRENCY = 32     # in-flight requests (reduce if you hit 429)
+RATE_LIMIT = 40          # requests per second (TMDB ceiling is ~40 req/s)
 SAVE_INTERVAL = 200      # save every N enriched movies
-REQUEST_SLEEP = 0.25     # pause between requests in same thread (seconds)
 MAX_RETRIES = 5          # per request retry attempts
+JOB_TIMEOUT = 300        # hard cap per movie incl. all retries (seconds)
 BACKOFF_BASE = 2         # exponential backoff base (on 429/5xx)
 FALLBACK_SEARCH = False  # if True, attempt search by title/year when id is missing
 
 # ====== HELPERS ======
-def safe_get(url, params, max_retries=MAX_RETRIES):
-    """GET with handling for 429 and transient errors. Returns response.json() or None."""
-    wait = 1.0
+class TokenBucket:
+    """Shared rate limiter: refills `rate` tokens/s up to `capacity`, one token per request."""
+    def __init__(self, rate=RATE_LIMIT, capacity=RATE_LIMIT):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                # not enough tokens yet -> sleep just long enough for one to refill
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+BUCKET = TokenBucket()
+
+def backoff_delay(attempt):
+    """Jittered exponential backoff (capped at 60s) so parallel retries don't sync up."""
+    return min(60, BACKOFF_BASE ** attempt) * (0.5 + random.random())
+
+def parse_retry_after(retry_after):
+    """Parse a Retry-After header (seconds or HTTP-date). Returns seconds or None."""
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def record_failed_id(movie_id):
+    """Remember ids that failed permanently so resumed runs stop re-fetching them."""
+    with open(FAILED_IDS_FILE, "a") as f:
+        f.write(f"{movie_id}\n")
+
+async def safe_get(client, url, params, max_retries=MAX_RETRIES, fail_id=None):
+    """GET with handling for 429 and transient errors. Returns response json or None.
+
+    If fail_id is given, a non-retryable 4xx records it in FAILED_IDS_FILE.
+    """
     for attempt in range(1, max_retries + 1):
+        await BUCKET.acquire()
         try:
-            r = requests.get(url, params=params, timeout=15)
-        except requests.RequestException as e:
+            r = await client.get(url, params=params)
+        except httpx.HTTPError as e:
             # network error -> backoff and retry
             if attempt == max_retries:
-                print(f" RequestException final: {e}")
+                print(f" RequestError final: {e}")
                 return None
-            time.sleep(wait)
-            wait *= BACKOFF_BASE
+            await asyncio.sleep(backoff_delay(attempt))
             continue
 
         if r.status_code == 200:
-            return r.json()
+            # orjson parses straight from bytes -- no intermediate str decode
+            return orjson.loads(r.content)
         if r.status_code == 429:
-            # Rate limited -> read Retry-After if present, else backoff
-            retry_after = r.headers.get("Retry-After")
-            if retry_after:
-                sleep_for = int(retry_after) + 1
-            else:
-                sleep_for = wait
-            print(f"  [429] rate limited. sleeping {sleep_for}s (attempt {attempt}/{max_retries})")
-            time.sleep(sleep_for)
-            wait *= BACKOFF_BASE
+            # Rate limited -> honor Retry-After if present, else jittered backoff
+            if attempt == max_retries:
+                break
+            sleep_for = parse_retry_after(r.headers.get("Retry-After", ""))
+            if sleep_for is None:
+                sleep_for = backoff_delay(attempt)
+            sleep_for = min(60, max(0, sleep_for))
+            print(f"  [429] rate limited. sleeping {sleep_for:.1f}s (attempt {attempt}/{max_retries})")
+            await asyncio.sleep(sleep_for)
             continue
         if 500 <= r.status_code < 600:
             # server error -> backoff
             print(f"  [5xx] server error {r.status_code}, attempt {attempt}/{max_retries}")
-            time.sleep(wait)
-            wait *= BACKOFF_BASE
+            if attempt == max_retries:
+                break
+            await asyncio.sleep(backoff_delay(attempt))
             continue
         # other client error (404, 401, etc.) -> don't retry
         # print(f"  [HTTP {r.status_code}] {url} -> skipping")
+        if fail_id is not None and r.status_code in (401, 404, 410):
+            record_failed_id(fail_id)
         return None
     return None
 
-def fetch_by_id(movie_id):
+async def fetch_by_id(client, movie_id):
     """Fetch detail + credits for a single movie id. Returns dict or None."""
-    base = "https://api.themoviedb.org/3"
-    params = {"api_key": TMDB_API_KEY}
-
-    # details
-    details = safe_get(f"{base}/movie/{movie_id}", params)
+    # details + credits in one round-trip (TMDB append_to_response)
+    details = await safe_get(client, f"/movie/{movie_id}", {"append_to_response": "credits"}, fail_id=movie_id)
     if not details:
         return None
 
-    # small pause to avoid bursting
-    time.sleep(REQUEST_SLEEP)
-
-    # credits
-    credits = safe_get(f"{base}/movie/{movie_id}/credits", params)
+    credits = details.get("credits")
     if not credits:
         # still return details if credits missing? we choose to return None,
         # you can change to return partial info by commenting the next line.
@@ -86,12 +138,10 @@ def fetch_by_id(movie_id):
             director = c.get("name")
             break
 
-    # top 3 cast average 'popularity' as proxy
-    top_cast = credits.get("cast", [])[:3]
-    top_cast_avg = None
-    if top_cast:
-        vals = [c.get("popularity", 0) for c in top_cast]
-        top_cast_avg = sum(vals) / len(vals)
+    # top 3 cast average 'popularity' as proxy (single pass, no temp list)
+    cast = credits.get("cast") or []
+    n = min(3, len(cast))
+    top_cast_avg = sum(cast[i].get("popularity", 0) for i in range(n)) / n if n else None
 
     return {
         "id": int(movie_id),
@@ -101,13 +151,12 @@ def fetch_by_id(movie_id):
         "top_cast_avg_rating": top_cast_avg
     }
 
-def search_and_get(title, year=None):
+async def search_and_get(client, title, year=None):
     """Optional fallback: search TMDB by title+year and return first match id (or None)."""
-    base = "https://api.themoviedb.org/3/search/movie"
-    params = {"api_key": TMDB_API_KEY, "query": title}
+    params = {"query": title}
     if year and not pd.isna(year):
         params["year"] = int(year)
-    data = safe_get(base, params)
+    data = await safe_get(client, "/search/movie", params)
     if not data:
         return None
     results = data.get("results", [])
@@ -115,6 +164,95 @@ def search_and_get(title, year=None):
         return None
     return results[0].get("id")
 
+PROGRESS_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("budget", pa.float64()),
+    ("revenue", pa.float64()),
+    ("director_encoded", pa.string()),
+    ("top_cast_avg_rating", pa.float64()),
+])
+
+def flush_progress(buffer):
+    """Append buffered results as one parquet part file (temp write + atomic rename)."""
+    if not buffer:
+        return
+    os.makedirs(TEMP_PROGRESS, exist_ok=True)
+    part = os.path.join(TEMP_PROGRESS, f"part-{uuid.uuid4().hex}.parquet")
+    tmp = os.path.join(TEMP_PROGRESS, f".part-{uuid.uuid4().hex}.tmp")  # dot-prefix: ignored by parquet readers
+    pq.write_table(pa.Table.from_pylist(buffer, schema=PROGRESS_SCHEMA), tmp)
+    os.replace(tmp, part)
+    buffer.clear()
+
+async def run_jobs(jobs):
+    """Fetch all jobs concurrently over one shared client, bounded by a semaphore.
+
+    Results stream to the progress dataset in SAVE_INTERVAL batches, so memory
+    stays flat no matter how many jobs there are. Returns the success count.
+    """
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    # one client for the whole run: pooled keep-alive connections, and the
+    # base URL + api key are merged in once instead of per call site
+    async with httpx.AsyncClient(
+        base_url="https://api.themoviedb.org/3",
+        params={"api_key": TMDB_API_KEY},
+        http2=True, limits=limits, timeout=15,
+    ) as client:
+
+        async def run_one(job):
+            async with sem:
+                mid = job["id"]
+                if mid is None:
+                    # find id via search then fetch
+                    mid = await search_and_get(client, job["title"], job.get("year"))
+                    if not mid:
+                        return None
+                return await fetch_by_id(client, mid)
+
+        # sliding in-flight window: never materialize more than a few hundred
+        # tasks, so tens of thousands of queued jobs don't pin memory and a
+        # 429 storm naturally back-pressures submission
+        window = MAX_CONCURRENCY * 4
+        job_iter = iter(jobs)
+        pending = set()
+        processed = 0
+        fetched = 0
+        new_since_flush = []
+        with tqdm(total=len(jobs), desc="Enriching") as pbar:
+            while True:
+                for job in islice(job_iter, window - len(pending)):
+                    pending.add(asyncio.ensure_future(asyncio.wait_for(run_one(job), JOB_TIMEOUT)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        res = future.result()
+                    except asyncio.TimeoutError:
+                        print(f" Job timed out after {JOB_TIMEOUT}s")
+                        res = None
+                    except Exception as e:
+                        print(f" Exception for job: {e}")
+                        res = None
+
+                    if res:
+                        new_since_flush.append(res)
+                        fetched += 1
+                    processed += 1
+                    pbar.update(1)
+
+                    # Checkpoint periodically: append only the results since the last flush
+                    if processed % SAVE_INTERVAL == 0:
+                        flush_progress(new_since_flush)
+                        print(f" Saved progress after {processed} processed jobs.")
+                        # small cooldown to be safe
+                        await asyncio.sleep(1)
+
+        # flush whatever is left from the final partial batch
+        flush_progress(new_since_flush)
+        return fetched
+
 # ====== MAIN ======
 def main():
     os.makedirs("data_cleaned", exist_ok=True)
@@ -129,103 +267,75 @@ def main():
 
     # determine which rows to enrich:
     # default: enrich rows where budget or revenue is missing
-    to_enrich = df[(df["budget"].isna() | df["revenue"].isna())].copy()
-    print(f"Total movies with missing budget/revenue: {len(to_enrich)}")
-
-    # Build list of (id,title,year) to process
-    tasks = []
-    for _, row in to_enrich.iterrows():
-        tasks.append({
-            "id": int(row["id"]) if pd.notna(row["id"]) else None,
-            "title": row.get("title"),
-            "year": row.get("release_year") if "release_year" in row else None
-        })
-
-    # load progress if exists
-    enriched = []
-    if os.path.exists(TEMP_PROGRESS):
-        print("Resuming from temp progress file...")
-        pdf = pd.read_csv(TEMP_PROGRESS)
-        enriched = pdf.to_dict(orient="records")
-        done_ids = {int(x["id"]) for x in enriched if pd.notna(x.get("id"))}
+    # (mask + flatnonzero only -- no row copy of the matched frame)
+    mask = df["budget"].isna().to_numpy() | df["revenue"].isna().to_numpy()
+    idx = np.flatnonzero(mask)
+    print(f"Total movies with missing budget/revenue: {len(idx)}")
+
+    # Build list of (id,title,year) to process (columnar; iterrows boxes every row)
+    ids = pd.to_numeric(df["id"], errors="coerce").to_numpy(dtype="float64")[idx]
+    titles = df["title"].to_numpy()[idx] if "title" in df.columns else np.full(len(idx), None, dtype=object)
+    years = df["release_year"].to_numpy()[idx] if "release_year" in df.columns else np.full(len(idx), np.nan)
+    tasks = [{"id": None if np.isnan(i) else int(i), "title": t, "year": y}
+             for i, t, y in zip(ids, titles, years)]
+
+    # load progress if exists (only the id column is needed for the skip set);
+    # dot-files are interrupted flushes, not readable parts
+    has_parts = os.path.isdir(TEMP_PROGRESS) and any(not f.startswith(".") for f in os.listdir(TEMP_PROGRESS))
+    if has_parts:
+        print("Resuming from progress dataset...")
+        pdf = pd.read_parquet(TEMP_PROGRESS, columns=["id"])
+        done_ids = set(pd.to_numeric(pdf["id"], errors="coerce").dropna().astype("int64").to_numpy().tolist())
     else:
         done_ids = set()
 
-    # prepare job list: either ids from tasks that are not done, or fallback search
+    # ids that previously failed permanently (404 etc.) are skipped too
+    failed_ids = set()
+    if os.path.exists(FAILED_IDS_FILE):
+        with open(FAILED_IDS_FILE) as f:
+            failed_ids = {int(line) for line in f if line.strip()}
+
+    # prepare job list: ids from tasks that are not done, or fallback search.
+    # the input CSV can carry duplicate TMDB ids -- fetch each id once.
     jobs = []
+    seen = set()
     for t in tasks:
-        if t["id"] is not None and t["id"] in done_ids:
+        if t["id"] is not None:
+            if t["id"] in done_ids or t["id"] in failed_ids or t["id"] in seen:
+                continue
+            seen.add(t["id"])
+        elif not FALLBACK_SEARCH:
+            # skip if no id and no fallback
             continue
         jobs.append(t)
 
-    print(f"Jobs to fetch: {len(jobs)} (skipping {len(done_ids)} already done)")
-
-    # Threaded fetching with cautious concurrency
-    # We'll submit jobs that use the id if present; if id absent and FALLBACK_SEARCH True, we will search then fetch
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as exe:
-        future_to_job = {}
-        for job in jobs:
-            mid = job["id"]
-            if mid is not None:
-                future = exe.submit(fetch_by_id, mid)
-                future_to_job[future] = job
-            else:
-                if FALLBACK_SEARCH:
-                    # find id via search then fetch
-                    def _search_and_fetch(job_inner):
-                        found = search_and_get(job_inner["title"], job_inner.get("year"))
-                        if not found:
-                            return None
-                        return fetch_by_id(found)
-                    future = exe.submit(_search_and_fetch, job)
-                    future_to_job[future] = job
-                else:
-                    # skip if no id and no fallback
-                    continue
+    print(f"Jobs to fetch: {len(jobs)} (skipping {len(done_ids)} done, {len(failed_ids)} permanently failed)")
 
-        processed = 0
-        for future in tqdm(as_completed(future_to_job), total=len(future_to_job), desc="Enriching"):
-            job = future_to_job[future]
-            try:
-                res = future.result()
-            except Exception as e:
-                print(f" Exception for job {job}: {e}")
-                res = None
-
-            if res:
-                enriched.append(res)
-            processed += 1
-
-            # Save periodically
-            if processed % SAVE_INTERVAL == 0:
-                pd.DataFrame(enriched).to_csv(TEMP_PROGRESS, index=False)
-                print(f" Saved progress after {processed} processed jobs.")
-                # small cooldown to be safe
-                time.sleep(SLEEP_BETWEEN_BATCHES if 'SLEEP_BETWEEN_BATCHES' in globals() else 1)
-
-    # final save of progress
-    pd.DataFrame(enriched).to_csv(TEMP_PROGRESS, index=False)
-    print(f"Done fetching. New enriched count: {len(enriched)}")
-
-    # Merge enriched back into original df
-    if len(enriched) > 0:
-        enriched_df = pd.DataFrame(enriched)
-        # ensure id dtype consistent
-        enriched_df["id"] = pd.to_numeric(enriched_df["id"], errors="coerce")
-        df["id"] = pd.to_numeric(df["id"], errors="coerce")
-        merged = df.merge(enriched_df, on="id", how="left", suffixes=("", "_new"))
+    # Async fetching: one event loop, one shared HTTP/2 client, bounded in-flight window
+    fetched = asyncio.run(run_jobs(jobs))
+    print(f"Done fetching. Newly enriched this run: {fetched}")
 
+    # Merge enriched back into original df (read the checkpoint dataset once)
+    enriched_df = pd.read_parquet(TEMP_PROGRESS) if os.path.isdir(TEMP_PROGRESS) else pd.DataFrame()
+    if len(enriched_df) > 0:
+        # fill NaN cells by id lookup -- no outer-merge allocation, no _new columns
+        lookup = enriched_df.drop_duplicates("id", keep="last").set_index("id")
+        id_col = pd.to_numeric(df["id"], errors="coerce")
         for col in ["budget", "revenue", "director_encoded", "top_cast_avg_rating"]:
-            if f"{col}_new" in merged.columns:
-                merged[col] = merged[col].combine_first(merged[f"{col}_new"])
-                merged.drop(columns=[f"{col}_new"], inplace=True, errors="ignore")
+            if col not in lookup.columns:
+                continue
+            vals = id_col.map(lookup[col])
+            df[col] = df[col].fillna(vals) if col in df.columns else vals
 
-        # recompute engineered cols
-        merged["budget_log"] = merged["budget"].apply(lambda x: math.log1p(x) if pd.notnull(x) and x>0 else None)
-        merged["revenue_log"] = merged["revenue"].apply(lambda x: math.log1p(x) if pd.notnull(x) and x>0 else None)
-        merged["profit_ratio"] = merged.apply(lambda r: r["revenue"]/r["budget"] if pd.notnull(r["budget"]) and r["budget"]>0 else None, axis=1)
+        # recompute engineered cols (vectorized; NaN where budget/revenue missing or <= 0)
+        b = df["budget"].to_numpy(dtype="float64")
+        r = df["revenue"].to_numpy(dtype="float64")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            df["budget_log"] = np.where(b > 0, np.log1p(b), np.nan)
+            df["revenue_log"] = np.where(r > 0, np.log1p(r), np.nan)
+            df["profit_ratio"] = np.where(b > 0, r / b, np.nan)
 
-        merged.to_csv(OUTPUT_CSV, index=False)
+        df.to_csv(OUTPUT_CSV, index=False)
         print(f"Enriched dataset saved to: {OUTPUT_CSV}")
     else:
         print("No new enrichment data fetched. Nothing to merge.")